@@ -4,23 +4,61 @@
 # License: MIT
 
 import asyncio
+import logging
+import os
+import queue
+import signal
+import socket
 
 from argparse import ArgumentParser
 from getpass import getpass
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from sys import stderr
 
 import asyncssh
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader # PyYAML was built without libyaml
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None # not available on all platforms
+
 
 config_host = ""
 config_port = 8022
 config_clients = {
     # username: asyncssh.SSHAuthorizedKeys
 }
+validated_keys = {
+    # (username, public key data): bool
+}
+validated_keys_max = 1024
+announcements = {
+    # username: (connected message, disconnected message)
+}
 enable_logging = False
-connected_clients = []
+logger = logging.getLogger("asserver")
+connected_clients = {
+    # asyncssh.SSHServerChannel: list (pending output)
+}
+flush_delay = 0.01 # seconds
+flush_threshold = 4096 # characters
+flush_pending = False
+pending_len = 0 # characters pending since the last flush
+max_pending = 1024 * 1024 # bytes waiting to be sent to a client before it gets kicked
+workers = 1
+peers = [
+    # asyncio.StreamWriter (to the other worker processes)
+]
+worker_pids = [
+    # int (the forked worker processes, only known to the parent)
+]
 
 
 class SSHServer(asyncssh.SSHServer):
@@ -31,56 +69,189 @@ class SSHServer(asyncssh.SSHServer):
     def begin_auth(self, username: str) -> bool: return True # we wanna handle auth
 
     def validate_public_key(self, username: str, key: asyncssh.SSHKey) -> bool:
+        cache_key = (username, key.public_data)
+        if cache_key in validated_keys:
+            return validated_keys[cache_key]
         try:
-            return config_clients[username].validate(key, "", "") is not None # checks client key
-        except:
-            return False
+            valid = config_clients[username].validate(key, "", "") is not None # checks client key
+        except (KeyError, ValueError):
+            # unknown user, or key options (e.g. from=) that can't be matched without the client's address
+            valid = False
+        if len(validated_keys) >= validated_keys_max:
+            del validated_keys[next(iter(validated_keys))] # drop the oldest entry
+        validated_keys[cache_key] = valid
+        return valid
 
 
-def broadcast(msg: str):
-    # Broadcast a message to all connected clients
-    assert type(msg) == str
-    msg = msg.strip("\r\n")
-    msg += "\n"
-    if enable_logging:
-        stderr.write(msg)
-    for c in connected_clients:
-        c.stdout.write(msg)
+def send(chan: asyncssh.SSHServerChannel, data: str):
+    # Write to a client, kick it if it doesn't keep up with its output
+    if chan.is_closing():
+        return
+    chan.write(data)
+    if chan.get_write_buffer_size() > max_pending:
+        if enable_logging:
+            logger.info(f"[slow client kicked] {chan.get_extra_info('username')}")
+        chan.abort() # its session ends and cleanup() announces it
+
+def flush():
+    # Write out the pending output of all clients, one write per client
+    global flush_pending, pending_len
+    flush_pending = False
+    pending_len = 0
+    prev, text = None, ""
+    for c, buf in connected_clients.items():
+        if buf:
+            if buf != prev: # most clients have the same pending output, join it only once
+                text = "".join(buf)
+                prev = buf
+            send(c, text)
+    for buf in connected_clients.values():
+        buf.clear()
+
+def broadcast(msg: str, relayed: bool = False):
+    # Broadcast a message (ending with a newline) to all connected clients
+    global flush_pending, pending_len
+    if not relayed:
+        if enable_logging:
+            for line in msg.rstrip("\n").split("\n"):
+                logger.info(line) # one record per line
+        if peers:
+            data = msg.encode()
+            for w in peers:
+                w.write(data) # the other workers broadcast it to their clients
+    n = len(connected_clients)
+    if n == 0:
+        return
+    if n == 1:
+        c, buf = next(iter(connected_clients.items()))
+        if not buf: # nothing pending that it has to come after
+            send(c, msg)
+            return
+    for buf in connected_clients.values():
+        buf.append(msg)
+    pending_len += len(msg)
+    if pending_len >= flush_threshold:
+        flush()
+    elif not flush_pending:
+        # coalesce bursts of messages into one write per client
+        flush_pending = True
+        asyncio.get_running_loop().call_later(flush_delay, flush)
 
-def cleanup(process: asyncssh.SSHServerProcess, username: str):
-    disconnected_msg = f"[disconnected] {username}"
+def cleanup(process: asyncssh.SSHServerProcess, disconnected_msg: str):
+    chan = process.channel
+    buf = connected_clients.pop(chan)
+    if buf:
+        send(chan, "".join(buf))
     process.exit(0)
-    connected_clients.remove(process)
     broadcast(disconnected_msg)
 
 async def handle_connection(process: asyncssh.SSHServerProcess):
-    connected_clients.append(process)
     username = process.get_extra_info("username")
-    # hello there
-    connected_msg = f"[connected] {username}"
-    broadcast(connected_msg)
+    connected_msg, disconnected_msg = announcements[username]
+    prefix = f"{username}: "
     if process.command is not None:
-        # client has provided a command as a ssh commandline argument
+        # client has provided a command as a ssh commandline argument,
+        # send everything in one go instead of three broadcasts
         line = process.command.strip("\r\n")
-        msg = f"{username}: {line}\n"
-        broadcast(msg)
-        cleanup(process, username)
+        msg = "".join((connected_msg, prefix, line, "\n"))
+        send(process.channel, msg)
+        process.exit(0)
+        broadcast(msg + disconnected_msg)
     else:
-        async def listen():
+        # we write to the channel directly, it takes str and still
+        # goes through the line editor (echo, newline translation)
+        connected_clients[process.channel] = []
+        # hello there
+        broadcast(connected_msg)
+        while True:
             try:
                 async for line in process.stdin:
-                    line = line.strip('\r\n')
-                    msg = f"{username}: {line}"
-                    broadcast(msg)
+                    broadcast("".join((prefix, line.rstrip("\r\n"), "\n")))
             except asyncssh.TerminalSizeChanged:
-                await listen() # we don't want to exit yet.
+                continue # we don't want to exit yet.
             except asyncssh.BreakReceived:
                 pass # we don't want to write an error message on this exception
             except Exception as e:
                 stderr.write(f"An error occured: {type(e).__name__} {e}\n")
                 stderr.flush()
-        await listen()
-        cleanup(process, username)
+            break
+        cleanup(process, disconnected_msg)
+
+
+async def relay(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # Broadcast the messages of another worker process to our clients
+    pending = bytearray()
+    try:
+        while data := await reader.read(65536):
+            pending.extend(data)
+            end = pending.rfind(b"\n") + 1 # only pass on complete messages
+            if end:
+                broadcast(pending[:end].decode(), relayed=True)
+                del pending[:end]
+    except ConnectionError:
+        pass # the other worker is gone
+    # stop forwarding messages to it
+    peers.remove(writer)
+    writer.close()
+
+def reap_workers(*_):
+    # SIGCHLD handler, collects workers that have exited,
+    # so they don't linger as zombies
+    for pid in worker_pids[:]:
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            worker_pids.remove(pid)
+
+def fork_workers(n: int) -> tuple:
+    # Fork n-1 additional worker processes and return the number of this
+    # worker (0 is the parent) and the sockets connecting it to all the
+    # others, ordered by the number of the other worker
+    links = {(i, j): socket.socketpair() for i in range(n) for j in range(i + 1, n)}
+    worker = 0
+    for i in range(1, n):
+        pid = os.fork()
+        if pid == 0:
+            worker = i
+            worker_pids.clear()
+            break
+        worker_pids.append(pid)
+    peer_socks = []
+    for (i, j), (a, b) in links.items():
+        if worker == i:
+            peer_socks.append(a)
+            b.close()
+        elif worker == j:
+            peer_socks.append(b)
+            a.close()
+        else:
+            a.close()
+            b.close()
+    return worker, peer_socks
+
+
+async def serve(private_key: asyncssh.SSHKey, worker: int, peer_socks: list):
+    relays = []
+    for sock in peer_socks:
+        reader, writer = await asyncio.open_connection(sock=sock)
+        peers.append(writer)
+        relays.append(asyncio.create_task(relay(reader, writer)))
+    # asyncssh doesn't limit the number of sessions per connection, so
+    # clients can multiplex sessions over one connection (e.g. OpenSSH's
+    # ControlMaster) and skip the key exchange and auth for each of them
+    server = await asyncssh.create_server(
+        SSHServer,
+        config_host,
+        config_port,
+        server_host_keys=[private_key],
+        process_factory=handle_connection,
+        reuse_port=workers > 1 # the kernel distributes connections across workers
+    )
+    if worker_pids:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel) # stop quietly
+    if worker == 0:
+        await server.serve_forever()
+    else:
+        await relays[0] # the link to the parent ends when it exits, so do we
 
 
 if __name__ == "__main__":
@@ -89,12 +260,18 @@ if __name__ == "__main__":
     argp.add_argument("config", type=Path, help="The path to the config file")
     argp.add_argument("pkey", type=Path, help="The path to the ssh private key")
     argp.add_argument("--log", action="store_true", help="Enable logging")
+    argp.add_argument("--workers", type=int, default=1, help="The number of worker processes (default: 1)")
     args = argp.parse_args()
+    if args.workers < 1:
+        argp.error("--workers must be at least 1")
+    if args.workers > 1 and not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+        argp.error("--workers requires os.fork() and SO_REUSEPORT, which aren't available on this platform")
     # read config
-    config = yaml.safe_load(args.config.read_text())
+    config = yaml.load(args.config.read_bytes(), Loader=SafeLoader)
     config_host = str(config["host"])
     config_port = int(config["port"])
     enable_logging = args.log
+    workers = args.workers
     try:
         config_private_key = asyncssh.import_private_key(args.pkey.read_text())
     except asyncssh.public_key.KeyImportError as e:
@@ -105,18 +282,37 @@ if __name__ == "__main__":
             raise e
     for c in config["clients"]:
         config_clients[str(c)] = asyncssh.import_authorized_keys(str(config["clients"][c]))
+        announcements[str(c)] = (f"[connected] {c}\n", f"[disconnected] {c}\n")
     # read private key
     server_public_key = config_private_key.export_public_key("openssh").decode().strip("\n\r")
     stderr.write(f"Server public key is \"{server_public_key}\"\n")
     stderr.flush()
     # start server
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(
-        asyncssh.create_server(
-            SSHServer,
-            config_host,
-            config_port,
-            server_host_keys=[config_private_key],
-            process_factory=handle_connection
-        ))
-    loop.run_forever()
+    worker, peer_socks = fork_workers(workers) if workers > 1 else (0, [])
+    if worker_pids:
+        signal.signal(signal.SIGCHLD, reap_workers)
+    elif worker > 0:
+        signal.signal(signal.SIGINT, signal.SIG_IGN) # the parent stops us
+    if enable_logging:
+        # write the log from a background thread, not the event loop
+        log_queue = queue.SimpleQueue()
+        log_listener = QueueListener(log_queue, logging.StreamHandler(stderr))
+        logger.addHandler(QueueHandler(log_queue))
+        logger.setLevel(logging.INFO)
+        log_listener.start()
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    try:
+        asyncio.run(serve(config_private_key, worker, peer_socks))
+    except asyncio.CancelledError:
+        pass # stopped by SIGTERM
+    finally:
+        if enable_logging:
+            log_listener.stop()
+        if worker_pids:
+            # stop the remaining workers and wait for them
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for pid in worker_pids:
+                os.kill(pid, signal.SIGTERM)
+            for pid in worker_pids:
+                os.waitpid(pid, 0)